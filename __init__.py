@@ -7,12 +7,9 @@ from .crud import db
 
 from fastapi.staticfiles import StaticFiles
 
-from lnbits.db import Database
 from lnbits.helpers import template_renderer
 from lnbits.tasks import catch_everything_and_restart
 
-db = Database("ext_bets4sats")
-
 
 bets4sats_ext: APIRouter = APIRouter(prefix="/bets4sats", tags=["Bets4Sats"])
 
@@ -55,7 +52,8 @@ def bets4sats_start() -> None:
 
     scheduled_tasks.extend([task_inv, task_reward, task_purge])
 
-    __all__ = [
+
+__all__ = [
     "db",
     "bets4sats_ext",
     "bets4sats_static_files",
@@ -1,24 +1,30 @@
 from __future__ import annotations
 
-import json
 import datetime
+import json
+import sqlite3
 from datetime import timedelta, timezone
-from typing import List, Optional, Union
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union
 
 import shortuuid
-from lnbits.db import Database
+from lnbits.db import SQLITE, Database, dict_to_model
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
 
 from .models import (
-    ChoiceAmountSum,
     Competition,
     CreateCompetition,
+    RegisterCompetition,
     Ticket,
     UpdateCompetition,
 )
 
 # ---------------------------------------------------------------------------
 # Database handle – one per extension (connection pooling handled by LNbits)
+#
+# Every Database instance gets its own engine, so import this handle rather
+# than constructing another. LNbits serializes connect() on a per-instance
+# lock, so this extension only ever runs one query at a time.
 # ---------------------------------------------------------------------------
 
 db = Database("ext_bets4sats")
@@ -30,6 +36,42 @@ db = Database("ext_bets4sats")
 INVOICE_EXPIRY = 15 * 60  # 15 minutes
 TICKET_PURGE_TIME = INVOICE_EXPIRY + 10  # safety margin
 
+# ---------------------------------------------------------------------------
+# Query helpers
+# ---------------------------------------------------------------------------
+
+
+def _in_values(prefix: str, values: List[str]) -> Tuple[str, Dict[str, str]]:
+    """Bind parameters for an ``IN (...)`` list: ``(":p0, :p1", {"p0": .., "p1": ..})``."""
+    params = {f"{prefix}{i}": value for i, value in enumerate(values)}
+    return ", ".join(f":{key}" for key in params), params
+
+
+TModel = TypeVar("TModel", bound=BaseModel)
+
+# SQLite only supports RETURNING since 3.35
+SUPPORTS_RETURNING = db.type != SQLITE or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+async def _execute_returning(
+    query: str,
+    values: dict,
+    model: Type[TModel],
+    refetch: Callable[[], Awaitable[Optional[TModel]]],
+) -> Optional[TModel]:
+    """Run a single-row write and return the written row, or None if no row matched.
+
+    Uses ``RETURNING *`` where available, otherwise *refetch* after the write.
+    LNbits' fetchone/fetchall never commit, so writes must go through execute.
+    """
+    if not SUPPORTS_RETURNING:
+        result = await db.execute(query, values)
+        return await refetch() if result.rowcount else None
+    result = await db.execute(f"{query} RETURNING *", values)
+    row = result.mappings().first()
+    return dict_to_model(dict(row), model) if row else None
+
+
 # ---------------------------------------------------------------------------
 # Ticket helpers
 # ---------------------------------------------------------------------------
@@ -45,144 +87,161 @@ async def create_ticket(
 ) -> Ticket:
     """Insert a new ticket in *INITIAL* state and decrement available tickets."""
 
-    await db.execute(
+    # -------------------------------------------------------------
+    # Decrement amount_tickets atomically while competition in INITIAL.
+    # Each statement commits on its own, so if the insert fails the ticket
+    # is given back explicitly.
+    # -------------------------------------------------------------
+    update_result = await db.execute(
         """
-        INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash)
-        VALUES (:id, :wallet, :competition, :amount, :reward_target, :choice, :state, :reward_msat, :reward_failure, :reward_payment_hash)
+        UPDATE bets4sats.competitions
+        SET amount_tickets = amount_tickets - 1
+        WHERE id = :id AND state = 'INITIAL' AND amount_tickets > 0
         """,
-        {
-            "id": ticket_id,
-            "wallet": wallet,
-            "competition": competition,
-            "amount": amount,
-            "reward_target": reward_target,
-            "choice": choice,
-            "state": "INITIAL",
-            "reward_msat": 0,
-            "reward_failure": "",
-            "reward_payment_hash": "",
-        },
+        {"id": competition},
     )
+    if not update_result.rowcount:
+        raise Exception("Competition is closed for new tickets")
 
-    # -------------------------------------------------------------
-    # Decrement amount_tickets atomically while competition in INITIAL
-    # -------------------------------------------------------------
-    while True:
-        competitiondata = await get_competition(competition)
-        assert competitiondata, "Couldn't get competition from ticket being created"
-        if competitiondata.state != "INITIAL":
-            break
-        amount_tickets = competitiondata.amount_tickets - 1
-        update_result = await db.execute(
+    try:
+        ticket = await _execute_returning(
             """
-            UPDATE bets4sats.competitions
-            SET amount_tickets = :amount_tickets
-            WHERE id = :id AND amount_tickets = :old_amount_tickets AND state = 'INITIAL'
+            INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash)
+            VALUES (:id, :wallet, :competition, :amount, :reward_target, :choice, :state, :reward_msat, :reward_failure, :reward_payment_hash)
             """,
             {
-                "amount_tickets": amount_tickets,
-                "id": competition,
-                "old_amount_tickets": competitiondata.amount_tickets,
+                "id": ticket_id,
+                "wallet": wallet,
+                "competition": competition,
+                "amount": amount,
+                "reward_target": reward_target,
+                "choice": choice,
+                "state": "INITIAL",
+                "reward_msat": 0,
+                "reward_failure": "",
+                "reward_payment_hash": "",
             },
+            Ticket,
+            lambda: get_ticket(ticket_id),
+        )
+    except Exception:
+        await db.execute(
+            "UPDATE bets4sats.competitions SET amount_tickets = amount_tickets + 1 WHERE id = :id",
+            {"id": competition},
         )
-        if update_result.rowcount:
-            break
+        raise
 
-    ticket = await get_ticket(ticket_id)
     assert ticket, "Newly created ticket couldn't be retrieved"
     return ticket
 
 
 async def purge_expired_tickets(competition_id: str) -> None:
     purge_time = datetime.datetime.now(timezone.utc) - datetime.timedelta(seconds=TICKET_PURGE_TIME)
-    delete_result = await db.execute(
-        f"""
+    delete_query = f"""
         DELETE FROM bets4sats.tickets
         WHERE competition = :competition AND state = 'INITIAL' AND time < {db.timestamp_placeholder('time')}
-        """,
-        {"competition": competition_id, "time": purge_time.timestamp()},
-    )
-
-    if not delete_result.rowcount:
-        return
+    """
+    values = {"competition": competition_id, "time": purge_time.timestamp()}
 
-    # Give back the freed capacity to the competition
-    while True:
-        competitiondata = await get_competition(competition_id)
-        assert competitiondata, "Couldn't get competition data for tickets being purged"
-        amount_tickets = competitiondata.amount_tickets + delete_result.rowcount
-        update_result = await db.execute(
-            """
+    if db.type != SQLITE:
+        # Delete and give back the freed capacity in one statement
+        await db.execute(
+            f"""
+            WITH purged AS ({delete_query} RETURNING 1)
             UPDATE bets4sats.competitions
-            SET amount_tickets = :amount_tickets
-            WHERE id = :id AND amount_tickets = :old_amount_tickets
+            SET amount_tickets = amount_tickets + (SELECT COUNT(*) FROM purged)
+            WHERE id = :competition AND EXISTS (SELECT 1 FROM purged)
             """,
-            {
-                "amount_tickets": amount_tickets,
-                "id": competition_id,
-                "old_amount_tickets": competitiondata.amount_tickets,
-            },
+            values,
         )
-        if update_result.rowcount:
-            break
-
+        return
 
-async def cas_ticket_state(ticket_id: str, old_state: str, new_state: str) -> bool:
-    update_result = await db.execute(
+    # SQLite has no data-modifying CTEs, so delete and give back separately.
+    # Each statement commits on its own; the give-back is not atomic with the
+    # delete.
+    delete_result = await db.execute(delete_query, values)
+    if not delete_result.rowcount:
+        return
+    await db.execute(
         """
+        UPDATE bets4sats.competitions
+        SET amount_tickets = amount_tickets + :purged
+        WHERE id = :id
+        """,
+        {"purged": delete_result.rowcount, "id": competition_id},
+    )
+
+
+async def claim_ticket(ticket_id: str, transitions: Dict[str, str]) -> Optional[Ticket]:
+    """Move the ticket to ``transitions[state]`` if its state is a key of *transitions*.
+
+    Returns the ticket in its new state, or None if it was not moved.
+    """
+    cases: List[str] = []
+    old_states: List[str] = []
+    values = {"id": ticket_id}
+    for i, (old_state, new_state) in enumerate(transitions.items()):
+        cases.append(f"WHEN :old_state{i} THEN :new_state{i}")
+        old_states.append(f":old_state{i}")
+        values[f"old_state{i}"] = old_state
+        values[f"new_state{i}"] = new_state
+    return await _execute_returning(
+        f"""
         UPDATE bets4sats.tickets
-        SET state = :new_state
-        WHERE id = :id AND state = :old_state
+        SET state = CASE state {" ".join(cases)} END
+        WHERE id = :id AND state IN ({", ".join(old_states)})
         """,
-        {"new_state": new_state, "id": ticket_id, "old_state": old_state},
+        values,
+        Ticket,
+        lambda: get_ticket(ticket_id),
     )
-    return bool(update_result.rowcount)
 
 
 async def set_ticket_funded(ticket_id: str) -> None:
-    cas_success = await cas_ticket_state(ticket_id, "INITIAL", "FUNDED")
-    if not cas_success:
+    ticket = await _execute_returning(
+        """
+        UPDATE bets4sats.tickets
+        SET state = 'FUNDED'
+        WHERE id = :id AND state = 'INITIAL'
+        """,
+        {"id": ticket_id},
+        Ticket,
+        lambda: get_ticket(ticket_id),
+    )
+    if not ticket:
         return
 
-    ticket = await get_ticket(ticket_id)
-    assert ticket, "Ticket not found after funding"
-
     # -------------------------------------------------------------
     # Update competition aggregates
     # -------------------------------------------------------------
-    while True:
-        competitiondata = await get_competition(ticket.competition)
-        assert competitiondata, "Couldn't get competition from ticket being paid"
-        if competitiondata.state != "INITIAL":
-            break
-        sold = competitiondata.sold + 1
-        choices = json.loads(competitiondata.choices)
-        choices[ticket.choice]["total"] += ticket.amount  # fixed variable name
-        update_result = await db.execute(
-            """
-            UPDATE bets4sats.competitions
-            SET sold = :sold, choices = :choices
-            WHERE id = :id AND sold = :old_sold AND state = 'INITIAL'
-            """,
-            {
-                "sold": sold,
-                "choices": json.dumps(choices),
-                "id": ticket.competition,
-                "old_sold": competitiondata.sold,
-            },
+    if db.type == SQLITE:
+        choices_total = "json_set(choices, :path, json_extract(choices, :path) + :amount)"
+        path: Union[str, List[str]] = f"$[{ticket.choice}].total"
+    else:
+        choices_total = (
+            "CAST(jsonb_set(CAST(choices AS jsonb), :path, "
+            "to_jsonb(CAST(CAST(choices AS jsonb) #>> :path AS bigint) + :amount)) AS TEXT)"
         )
-        if update_result.rowcount:
-            break
+        path = [str(ticket.choice), "total"]
+    await db.execute(
+        f"""
+        UPDATE bets4sats.competitions
+        SET sold = sold + 1, choices = {choices_total}
+        WHERE id = :id AND state = 'INITIAL'
+        """,
+        {"path": path, "amount": ticket.amount, "id": ticket.competition},
+    )
 
 
 async def update_ticket(ticket_id: str, **kwargs) -> Ticket:
     setters = ", ".join([f"{field} = :{field}" for field in kwargs])
     params = {**kwargs, "id": ticket_id}
-    await db.execute(
+    ticket = await _execute_returning(
         f"UPDATE bets4sats.tickets SET {setters} WHERE id = :id",
         params,
+        Ticket,
+        lambda: get_ticket(ticket_id),
     )
-    ticket = await get_ticket(ticket_id)
     assert ticket, "Newly updated ticket couldn't be retrieved"
     return ticket
 
@@ -195,13 +254,37 @@ async def get_ticket(ticket_id: str) -> Optional[Ticket]:
     )
 
 
+async def get_ticket_with_competition(ticket_id: str) -> Optional[Tuple[Ticket, Competition]]:
+    prefix = "competition__"
+    competition_columns = ", ".join(f"c.{field} AS {prefix}{field}" for field in Competition.__fields__)
+    row = await db.fetchone(
+        f"""
+        SELECT t.*, {competition_columns}
+        FROM bets4sats.tickets t
+        JOIN bets4sats.competitions c ON c.id = t.competition
+        WHERE t.id = :id
+        """,
+        {"id": ticket_id},
+    )
+    if not row:
+        return None
+    ticket_row = {key: value for key, value in row.items() if not key.startswith(prefix)}
+    competition_row = {
+        key[len(prefix):]: value for key, value in row.items() if key.startswith(prefix)
+    }
+    return dict_to_model(ticket_row, Ticket), dict_to_model(competition_row, Competition)
+
+
 async def get_tickets(wallet_ids: Union[str, List[str]]) -> List[Ticket]:
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
-    q = ",".join([f"'{wallet_id}'" for wallet_id in wallet_ids])
+    if not wallet_ids:
+        return []
+    q, values = _in_values("wallet", wallet_ids)
     return await db.fetchall(
         f"SELECT * FROM bets4sats.tickets WHERE wallet IN ({q})",
-        model=Ticket,
+        values,
+        Ticket,
     )
 
 
@@ -225,7 +308,7 @@ async def create_competition(data: CreateCompetition) -> Competition:
         {"title": choice["title"], "total": 0}
         for choice in json.loads(data.choices)
     ])
-    await db.execute(
+    competition = await _execute_returning(
         """
         INSERT INTO bets4sats.competitions (
             id, wallet, register_id, name, info, banner, closing_datetime,
@@ -248,8 +331,9 @@ async def create_competition(data: CreateCompetition) -> Competition:
             "max_bet": data.max_bet,
             "choices": choices_json,
         },
+        Competition,
+        lambda: get_competition(competition_id),
     )
-    competition = await get_competition(competition_id)
     assert competition, "Newly created competition couldn't be retrieved"
     return competition
 
@@ -268,13 +352,12 @@ async def update_competition(competition_id: str, data: UpdateCompetition) -> Op
     if not setters:
         return await get_competition(competition_id)
 
-    update_result = await db.execute(
+    return await _execute_returning(
         f"UPDATE bets4sats.competitions SET {', '.join(setters)} WHERE id = :id AND state = 'INITIAL'",
         params,
+        Competition,
+        lambda: get_competition(competition_id),
     )
-    if not update_result.rowcount:
-        return None
-    return await get_competition(competition_id)
 
 
 async def cas_competition_state(competition_id: str, old_state: str, new_state: str) -> bool:
@@ -300,7 +383,7 @@ async def set_winning_choice(competition_id: str, winning_choice: int) -> None:
     )
 
 
-async def sum_choices_amounts(competition_id: str) -> List[ChoiceAmountSum]:
+async def sum_choices_amounts(competition_id: str) -> Dict[int, int]:
     rows = await db.fetchall(
         """
         SELECT choice, SUM(amount) AS amount_sum
@@ -310,7 +393,7 @@ async def sum_choices_amounts(competition_id: str) -> List[ChoiceAmountSum]:
         """,
         {"competition": competition_id},
     )
-    return [ChoiceAmountSum(**row) for row in rows]
+    return {row["choice"]: int(row["amount_sum"]) for row in rows}
 
 
 async def update_competition_winners(competition_id: str, choices: str, winning_choice: int):
@@ -332,20 +415,12 @@ async def update_competition_winners(competition_id: str, choices: str, winning_
             {"competition": competition_id},
         )
     else:
-        # Mark winners / losers accordingly
+        # Mark winners / losers accordingly in a single pass
         await db.execute(
             """
             UPDATE bets4sats.tickets
-            SET state = 'WON_UNPAID'
-            WHERE competition = :competition AND state = 'FUNDED' AND choice = :winning_choice
-            """,
-            {"competition": competition_id, "winning_choice": winning_choice},
-        )
-        await db.execute(
-            """
-            UPDATE bets4sats.tickets
-            SET state = 'LOST'
-            WHERE competition = :competition AND state = 'FUNDED' AND choice != :winning_choice
+            SET state = CASE WHEN choice = :winning_choice THEN 'WON_UNPAID' ELSE 'LOST' END
+            WHERE competition = :competition AND state = 'FUNDED'
             """,
             {"competition": competition_id, "winning_choice": winning_choice},
         )
@@ -359,21 +434,32 @@ async def get_competition(competition_id: str) -> Optional[Competition]:
     )
 
 
+async def get_competition_for_register(competition_id: str) -> Optional[RegisterCompetition]:
+    return await db.fetchone(
+        "SELECT id, name, register_id, choices FROM bets4sats.competitions WHERE id = :id",
+        {"id": competition_id},
+        RegisterCompetition,
+    )
+
+
 async def get_competitions(wallet_ids: Union[str, List[str]]) -> List[Competition]:
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
-    q = ",".join([f"'{wallet_id}'" for wallet_id in wallet_ids])
+    if not wallet_ids:
+        return []
+    q, values = _in_values("wallet", wallet_ids)
     return [
         Competition(**row)
         for row in await db.fetchall(
             f"SELECT * FROM bets4sats.competitions WHERE wallet IN ({q})",
+            values,
         )
     ]
 
 
-async def get_all_competitions() -> List[Competition]:
-    rows = await db.fetchall("SELECT * FROM bets4sats.competitions")
-    return [Competition(**row) for row in rows]
+async def get_competition_ids() -> List[str]:
+    rows = await db.fetchall("SELECT id FROM bets4sats.competitions")
+    return [row["id"] for row in rows]
 
 
 async def delete_competition(competition_id: str) -> None:
@@ -395,12 +481,12 @@ async def get_wallet_competition_tickets(competition_id: str) -> List[Ticket]:
 
 async def get_state_competition_tickets(competition_id: str, states: List[str]) -> List[Ticket]:
     assert states, "get_state_competition_tickets called with no states"
-    placeholders = ",".join([f"'{state}'" for state in states])
+    placeholders, values = _in_values("state", states)
     return [
         Ticket(**row)
         for row in await db.fetchall(
             f"SELECT * FROM bets4sats.tickets WHERE competition = :competition AND state IN ({placeholders})",
-            {"competition": competition_id},
+            {"competition": competition_id, **values},
         )
     ]
 
@@ -408,11 +494,12 @@ async def get_state_competition_tickets(competition_id: str, states: List[str])
 async def is_competition_payment_complete(competition_id: str) -> bool:
     row = await db.fetchone(
         """
-        SELECT id FROM bets4sats.tickets
-        WHERE competition = :competition
-        AND state NOT IN ('CANCELLED_PAID', 'CANCELLED_PAYMENT_FAILED', 'WON_PAID', 'WON_PAYMENT_FAILED', 'LOST')
-        LIMIT 1
+        SELECT EXISTS (
+            SELECT 1 FROM bets4sats.tickets
+            WHERE competition = :competition
+            AND state NOT IN ('CANCELLED_PAID', 'CANCELLED_PAYMENT_FAILED', 'WON_PAID', 'WON_PAYMENT_FAILED', 'LOST')
+        ) AS has_open
         """,
         {"competition": competition_id},
     )
-    return not bool(row)
+    return not row["has_open"]
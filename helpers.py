@@ -14,7 +14,7 @@ from starlette.exceptions import HTTPException
 import httpx
 from loguru import logger
 
-from .crud import get_competition, get_ticket, set_ticket_funded
+from .crud import get_ticket_with_competition, set_ticket_funded
 from .models import LnurlpParameters
 
 # Similar to /api/v1/lnurlscan/{code}
@@ -149,18 +149,13 @@ async def send_ticket(competition_id, ticket_id):
             status_code=HTTPStatus.BAD_REQUEST,
             detail="Invalid ticket id.",
         )
-    competition = await get_competition(competition_id)
-    if not competition:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND,
-            detail="Competition could not be fetched.",
-        )
-    ticket = await get_ticket(ticket_id)
-    if not ticket or ticket.competition_id != competition_id:
+    ticket_with_competition = await get_ticket_with_competition(ticket_id)
+    if not ticket_with_competition or ticket_with_competition[1].id != competition_id:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail="Ticket could not be fetched, or invoice has expired.",
         )
+    _ticket, competition = ticket_with_competition
     # TODO: Save payment-hash on ticket, so we could use get_standalone_payment()
     # instead of get_payments()
     all_payments = await get_payments(
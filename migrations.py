@@ -4,6 +4,9 @@
 # NOTE: every table that must exist in a _fresh_ install goes in m001_initial.
 # Add m00X_* functions only for _future_ changes to that baseline.
 
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
     # == competitions =========================================
     await db.execute(
@@ -50,3 +53,25 @@ async def m001_initial(db):
         );
         """
     )
+
+
+async def m002_add_indexes(db):
+    """
+    Index the tickets columns every hot query filters on.
+    """
+    indexes = [
+        ("idx_tickets_comp_state", "(competition, state)", ""),
+        ("idx_tickets_wallet", "(wallet)", ""),
+        # only unpaid tickets are ever purged by age
+        ("idx_tickets_comp_time", "(competition, time)", "WHERE state = 'INITIAL'"),
+    ]
+    for name, columns, where in indexes:
+        if db.type == SQLITE:
+            # SQLite qualifies the index name, not the table, with the schema
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS bets4sats.{name} ON tickets {columns} {where}"
+            )
+        else:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS {name} ON bets4sats.tickets {columns} {where}"
+            )
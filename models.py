@@ -1,5 +1,7 @@
 
+import json
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
 from fastapi import Query
@@ -7,6 +9,15 @@ from pydantic import BaseModel, EmailStr
 
 MAX_SATS=21_000_000_00_000_000
 
+@lru_cache(maxsize=256)
+def parse_choices(choices: str) -> list:
+    # Shared between callers - treat the result as read-only
+    return json.loads(choices)
+
+@lru_cache(maxsize=256)
+def dump_banner(banner: str) -> str:
+    return json.dumps(banner)
+
 class CreateCompetition(BaseModel):
     wallet: str
     name: str
@@ -48,6 +59,21 @@ class Competition(BaseModel):
     state: str
     time: int
 
+    @property
+    def choices_list(self) -> list:
+        return parse_choices(self.choices)
+
+    @property
+    def banner_json(self) -> str:
+        return dump_banner(self.banner)
+
+
+class RegisterCompetition(BaseModel):
+    id: str
+    name: str
+    register_id: str
+    choices: str
+
 
 class Ticket(BaseModel):
     id: str
@@ -64,10 +90,6 @@ class Ticket(BaseModel):
     reward_payment_hash: str
     time: int
 
-class ChoiceAmountSum(BaseModel):
-    choice: int
-    amount_sum: int
-
 class LnurlpParameters(BaseModel):
     minSendable: int
     maxSendable: int
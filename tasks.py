@@ -1,23 +1,39 @@
 import asyncio
-import json
 from time import sleep
+from typing import Dict, List, Set
 
 from lnbits.core.models import Payment
 from lnbits.helpers import get_current_extension_name
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import cas_competition_state, get_ticket, cas_ticket_state, get_competition, update_ticket, is_competition_payment_complete, get_all_competitions, TICKET_PURGE_TIME
+from .crud import cas_competition_state, claim_ticket, get_competition, update_ticket, is_competition_payment_complete, get_competition_ids, purge_expired_tickets, TICKET_PURGE_TIME
 from .helpers import pay_lnurlp, send_ticket
+from .models import Competition, Ticket
 
 PRIZE_FEE_PERCENT = 1
+REWARD_BATCH_SIZE = 100
+PAYING_STATES = {
+    "WON_UNPAID": "WON_PAYING",
+    "WON_PAYMENT_FAILED": "WON_PAYING",
+    "CANCELLED_UNPAID": "CANCELLED_PAYING",
+    "CANCELLED_PAYMENT_FAILED": "CANCELLED_PAYING"
+}
+PAYMENT_FAILED_STATES = {
+    "CANCELLED_PAYING": "CANCELLED_PAYMENT_FAILED",
+    "WON_PAYING": "WON_PAYMENT_FAILED"
+}
 
 async def purge_tickets_loop():
     while True:
         await asyncio.sleep(TICKET_PURGE_TIME // 2)
-+        competitions = await get_all_competitions()
-        for competition in competitions:
-            await purge_expired_tickets(competition.id)
+        # Every state: leftover unpaid tickets also block COMPLETED_PAID
+        competition_ids = await get_competition_ids()
+        for competition_id in competition_ids:
+            try:
+                await purge_expired_tickets(competition_id)
+            except Exception as exception:
+                logger.warning(f"purge_tickets_loop: failed: {competition_id} {exception}")
 
 reward_ticket_ids_queue = asyncio.Queue()
 
@@ -49,49 +65,66 @@ async def on_invoice_paid(payment: Payment) -> None:
 async def wait_for_reward_ticket_ids():
     logger.info("wait_for_reward_ticket_ids: started")
     while True:
-        ticket_id = await reward_ticket_ids_queue.get()
-        await on_reward_ticket_id(ticket_id)
+        # Take everything queued so far, so each competition is checked once
+        ticket_ids = [await reward_ticket_ids_queue.get()]
+        while len(ticket_ids) < REWARD_BATCH_SIZE and not reward_ticket_ids_queue.empty():
+            ticket_ids.append(reward_ticket_ids_queue.get_nowait())
+        await on_reward_ticket_ids(ticket_ids)
 
-async def on_reward_ticket_id(ticket_id: str) -> None:
-    logger.info(f"on_reward_ticket_id: called {ticket_id}")
-    ticket = await get_ticket(ticket_id)
-    if not ticket:
-        logger.warning(f"on_reward_ticket_id: ticket not found, deleted before handled? {ticket_id}")
-        return
-    logger.info(f"on_reward_ticket_id: handling ticket: {ticket}")
-    new_state = {
-        "WON_UNPAID": "WON_PAYING",
-        "WON_PAYMENT_FAILED": "WON_PAYING",
-        "CANCELLED_UNPAID": "CANCELLED_PAYING",
-        "CANCELLED_PAYMENT_FAILED": "CANCELLED_PAYING"
-    }.get(ticket.state)
-    logger.info(f"on_reward_ticket_id: new state: {ticket_id} {new_state}")
-    if not new_state:
-        return
-    cas_success = await cas_ticket_state(ticket_id, ticket.state, new_state)
-    if not cas_success:
-        logger.info(f"on_reward_ticket_id: cas failed: {ticket_id}")
-        return
+async def on_reward_ticket_ids(ticket_ids: List[str]) -> None:
+    logger.info(f"on_reward_ticket_ids: called {ticket_ids}")
+    competitions: Dict[str, Competition] = {}
+    competition_ids: Set[str] = set()
+    for ticket_id in ticket_ids:
+        # Claim each ticket right before paying it, so a restart strands at
+        # most one ticket in *_PAYING
+        ticket = await claim_ticket(ticket_id, PAYING_STATES)
+        if not ticket:
+            logger.info(f"on_reward_ticket_ids: not payable or cas failed: {ticket_id}")
+            continue
+        competition_ids.add(ticket.competition)
+        try:
+            await pay_ticket_reward(ticket, competitions)
+        except Exception as exception:
+            # The payment may already have gone out, so leave the ticket in
+            # *_PAYING rather than make it retryable
+            logger.warning(f"on_reward_ticket_ids: failed, left in {ticket.state}: {ticket_id} {exception}")
+    for competition_id in competition_ids:
+        try:
+            competition_complete = await is_competition_payment_complete(competition_id)
+            logger.info(f"on_reward_ticket_ids: competition_complete: {competition_id} {competition_complete}")
+            if competition_complete:
+                await cas_competition_state(
+                    competition_id,
+                    "COMPLETED_PAYING",
+                    "COMPLETED_PAID"
+                )
+        except Exception as exception:
+            logger.warning(f"on_reward_ticket_ids: completion check failed: {competition_id} {exception}")
+
+async def pay_ticket_reward(ticket: Ticket, competitions: Dict[str, Competition]) -> None:
+    ticket_id = ticket.id
+    logger.info(f"pay_ticket_reward: handling ticket: {ticket}")
     final_reward_msat = 0
     try:
-        # get ticket again
-        ticket = await get_ticket(ticket_id)
-        if not ticket:
-            logger.info(f"on_reward_ticket_id: failed to re-get ticket: {ticket_id}")
-            return
         if ticket.state == "CANCELLED_PAYING":
             reward_msat = ticket.amount * 1000
             description_prefix = "Bets4SatsRefund"
         else: # WON_PAYING
-            competition = await get_competition(ticket.competition)
-            logger.info(f"on_reward_ticket_id: got competition: {ticket_id} {competition}")
-            choices = json.loads(competition.choices)
-            logger.info(f"on_reward_ticket_id: calculating reward: {ticket_id}")
+            competition = competitions.get(ticket.competition)
+            if competition is None:
+                competition = await get_competition(ticket.competition)
+                if competition is None:
+                    raise Exception("Competition not found")
+                competitions[ticket.competition] = competition
+            logger.info(f"pay_ticket_reward: got competition: {ticket_id} {competition}")
+            choices = competition.choices_list
+            logger.info(f"pay_ticket_reward: calculating reward: {ticket_id}")
             total_msat = sum(choice["total"] for choice in choices) * 1000
             reward_msat = total_msat * ticket.amount * (100 - PRIZE_FEE_PERCENT) // (choices[ticket.choice]["total"] * 100)
             description_prefix = "Bets4SatsReward"
-        logger.info(f"on_reward_ticket_id: reward_msat: {ticket_id} {reward_msat}")
-        logger.info(f"on_reward_ticket_id: paying lnurlp: {ticket_id}")
+        logger.info(f"pay_ticket_reward: reward_msat: {ticket_id} {reward_msat}")
+        logger.info(f"pay_ticket_reward: paying lnurlp: {ticket_id}")
         payment_hash, final_reward_msat = await pay_lnurlp(
             ticket.wallet,
             ticket.reward_target,
@@ -100,17 +133,14 @@ async def on_reward_ticket_id(ticket_id: str) -> None:
             {"tag":"bets4sats"}
         )
     except Exception as exception:
-        logger.warning(f"on_reward_ticket_id: failed: {ticket_id} {exception}")
+        logger.warning(f"pay_ticket_reward: failed: {ticket_id} {exception}")
         await update_ticket(
             ticket_id,
-            state={
-                "CANCELLED_PAYING": "CANCELLED_PAYMENT_FAILED",
-                "WON_PAYING": "WON_PAYMENT_FAILED"
-            }[ticket.state],
+            state=PAYMENT_FAILED_STATES[ticket.state],
             reward_failure=str(exception)
         )
     else:
-        logger.info(f"on_reward_ticket_id: updating ticket to paid: {ticket_id}")
+        logger.info(f"pay_ticket_reward: updating ticket to paid: {ticket_id}")
         await update_ticket(
             ticket.id,
             state={
@@ -121,11 +151,3 @@ async def on_reward_ticket_id(ticket_id: str) -> None:
             reward_msat=final_reward_msat,
             reward_payment_hash=payment_hash
         )
-    competition_complete = await is_competition_payment_complete(ticket.competition)
-    logger.info(f"on_reward_ticket_id: competition_complete: {ticket_id} {competition_complete}")
-    if competition_complete:
-        await cas_competition_state(
-            ticket.competition,
-            "COMPLETED_PAYING",
-            "COMPLETED_PAID"
-        )
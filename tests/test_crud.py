@@ -0,0 +1,114 @@
+import pytest
+import pytest_asyncio
+
+from ..crud import (
+    claim_ticket,
+    create_competition,
+    create_ticket,
+    db,
+    get_competition,
+    get_ticket,
+    set_ticket_funded,
+    update_competition,
+    update_ticket,
+)
+from ..migrations import m001_initial, m002_add_indexes
+from ..models import CreateCompetition, UpdateCompetition
+
+
+@pytest_asyncio.fixture
+async def tables():
+    await m001_initial(db)
+    await m002_add_indexes(db)
+    yield
+    await db.execute("DROP TABLE bets4sats.tickets")
+    await db.execute("DROP TABLE bets4sats.competitions")
+
+
+async def _create_competition(amount_tickets: int = 10):
+    return await create_competition(
+        CreateCompetition(
+            wallet="wallet",
+            name="Final",
+            info="",
+            banner="",
+            closing_datetime="2030-01-01T00:00:00.000Z",
+            amount_tickets=amount_tickets,
+            min_bet=1,
+            max_bet=1000,
+            choices='[{"title": "a"}, {"title": "b"}]',
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_competition_is_persisted(tables):
+    competition = await _create_competition()
+    assert await get_competition(competition.id) == competition
+
+
+@pytest.mark.asyncio
+async def test_update_competition_is_persisted(tables):
+    competition = await _create_competition()
+    updated = await update_competition(
+        competition.id, UpdateCompetition(closing_datetime=None, amount_tickets=3)
+    )
+    assert updated and updated.amount_tickets == 3
+    stored = await get_competition(competition.id)
+    assert stored and stored.amount_tickets == 3
+
+
+@pytest.mark.asyncio
+async def test_create_ticket_is_persisted(tables):
+    competition = await _create_competition(amount_tickets=1)
+    ticket = await create_ticket("ticket1", "wallet", competition.id, 10, "target", 1)
+    assert await get_ticket("ticket1") == ticket
+    stored = await get_competition(competition.id)
+    assert stored and stored.amount_tickets == 0
+    with pytest.raises(Exception, match="closed for new tickets"):
+        await create_ticket("ticket2", "wallet", competition.id, 10, "target", 1)
+    assert await get_ticket("ticket2") is None
+
+
+@pytest.mark.asyncio
+async def test_update_ticket_is_persisted(tables):
+    competition = await _create_competition()
+    await create_ticket("ticket1", "wallet", competition.id, 10, "target", 0)
+    ticket = await update_ticket("ticket1", reward_failure="boom")
+    assert ticket.reward_failure == "boom"
+    stored = await get_ticket("ticket1")
+    assert stored and stored.reward_failure == "boom"
+
+
+@pytest.mark.asyncio
+async def test_set_ticket_funded_counts_once(tables):
+    competition = await _create_competition()
+    await create_ticket("ticket1", "wallet", competition.id, 10, "target", 1)
+    for _ in range(3):
+        await set_ticket_funded("ticket1")
+    ticket = await get_ticket("ticket1")
+    assert ticket and ticket.state == "FUNDED"
+    stored = await get_competition(competition.id)
+    assert stored
+    assert stored.sold == 1
+    assert [choice["total"] for choice in stored.choices_list] == [0, 10]
+
+
+@pytest.mark.asyncio
+async def test_claim_ticket_is_persisted(tables):
+    competition = await _create_competition()
+    await create_ticket("won", "wallet", competition.id, 10, "target", 0)
+    await create_ticket("lost", "wallet", competition.id, 10, "target", 1)
+    await update_ticket("won", state="WON_UNPAID")
+    await update_ticket("lost", state="LOST")
+    transitions = {"WON_UNPAID": "WON_PAYING"}
+    ticket = await claim_ticket("won", transitions)
+    assert ticket and ticket.state == "WON_PAYING"
+    won = await get_ticket("won")
+    assert won and won.state == "WON_PAYING"
+    # already claimed, or not in a claimable state
+    assert await claim_ticket("won", transitions) is None
+    assert await claim_ticket("lost", transitions) is None
+    lost = await get_ticket("lost")
+    assert lost and lost.state == "LOST"
+    assert await claim_ticket("missing", transitions) is None
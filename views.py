@@ -1,4 +1,3 @@
-import json
 import hmac
 from datetime import date, datetime
 from http import HTTPStatus
@@ -12,7 +11,11 @@ from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 
 from . import bets4sats_ext, bets4sats_renderer
-from .crud import get_competition, get_ticket
+from .crud import (
+    get_competition,
+    get_competition_for_register,
+    get_ticket_with_competition,
+)
 
 templates = Jinja2Templates(directory="templates")
 
@@ -39,7 +42,7 @@ async def display(request: Request, competition_id):
             "competition_id": competition_id,
             "competition_name": competition.name,
             "competition_info": competition.info,
-            "competition_banner": json.dumps(competition.banner),
+            "competition_banner": competition.banner_json,
             "competition_state": competition.state,
             "competition_closing_datetime": competition.closing_datetime,
             "competition_choices": competition.choices,
@@ -53,17 +56,12 @@ async def display(request: Request, competition_id):
 
 @bets4sats_ext.get("/tickets/{ticket_id}", response_class=HTMLResponse)
 async def ticket(request: Request, ticket_id):
-    ticket = await get_ticket(ticket_id)
-    if not ticket:
+    ticket_with_competition = await get_ticket_with_competition(ticket_id)
+    if not ticket_with_competition:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Ticket does not exist."
         )
-
-    competition = await get_competition(ticket.competition)
-    if not competition:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."
-        )
+    ticket, competition = ticket_with_competition
 
     return bets4sats_renderer().TemplateResponse(
         "bets4sats/ticket.html",
@@ -73,7 +71,7 @@ async def ticket(request: Request, ticket_id):
             "ticket_amount": ticket.amount,
             "competition_name": competition.name,
             "competition_id": competition.id,
-            "ticket_choice": json.loads(competition.choices)[ticket.choice]["title"],
+            "ticket_choice": competition.choices_list[ticket.choice]["title"],
             "ticket_state": ticket.state,
         },
     )
@@ -81,7 +79,7 @@ async def ticket(request: Request, ticket_id):
 
 @bets4sats_ext.get("/register/{competition_id}/{register_id}", response_class=HTMLResponse)
 async def register(request: Request, competition_id, register_id):
-    competition = await get_competition(competition_id)
+    competition = await get_competition_for_register(competition_id)
     if competition is None or not hmac.compare_digest(competition.register_id, register_id):
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."
@@ -24,6 +24,7 @@ from .crud import (
     delete_competition_tickets,
     delete_ticket,
     get_competition,
+    get_competition_for_register,
     get_state_competition_tickets,
     get_wallet_competition_tickets,
     get_competitions,
@@ -117,12 +118,10 @@ async def api_competition_complete(data: CompleteCompetition, competition_id: st
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="winning_choice too high")
     if data.winning_choice >= 0 and choices[data.winning_choice]["total"] == 0:
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="no bet on winning choice")
-    for choice in choices:
-        choice["pre_agg_total"] = choice["total"]
-        choice["total"] = 0
     choice_amount_sums = await sum_choices_amounts(competition.id)
-    for choice_amount_sum in choice_amount_sums:
-        choices[choice_amount_sum.choice]["total"] = choice_amount_sum.amount_sum
+    for choice_index, choice in enumerate(choices):
+        choice["pre_agg_total"] = choice["total"]
+        choice["total"] = choice_amount_sums.get(choice_index, 0)
     await update_competition_winners(competition_id, json.dumps(choices), data.winning_choice)
     unpaid_tickets = await get_state_competition_tickets(competition_id, ["WON_UNPAID", "CANCELLED_UNPAID"])
     for ticket in unpaid_tickets:
@@ -178,7 +177,7 @@ async def api_ticket_make_ticket(competition_id, data: CreateInvoiceForTicket):
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Amount must be between Min-Bet and Max-Bet"
         )
-    if data.choice < 0 or data.choice >= len(json.loads(competition.choices)):
+    if data.choice < 0 or data.choice >= len(competition.choices_list):
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Invalid choice"
         )
@@ -238,7 +237,7 @@ async def api_ticket_delete(ticket_id, wallet: WalletTypeInfo = Depends(get_key_
 
 @bets4sats_ext.get("/api/v1/competitiontickets/{competition_id}/{register_id}")
 async def api_competition_tickets(competition_id, register_id):
-    competition = await get_competition(competition_id)
+    competition = await get_competition_for_register(competition_id)
     if competition is None or not hmac.compare_digest(competition.register_id, register_id):
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."